@@ -4,17 +4,67 @@ import sys
 import os
 import datetime
 import shutil
-import json
+import errno
+import itertools
+import orjson
+import hashlib
+import sqlite3
+from urllib.request import pathname2url
 import ffmpeg
-import filecmp
+import exifread
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from rich.progress import track, Progress
 from PIL import Image
 from PIL import ExifTags
 
-allowed_picture_extensions = ['.jpg', '.JPG', '.jpeg', '.JPEG', '.png', '.PNG', '.gif', '.GIF', '.NEF', '.CR2', '.dng', '.bmp']
-pictures_with_exif = ['.jpg', '.JPG', '.jpeg', '.JPEG']
+# Extensions are lowercase, compare them against the lowercased filename
+allowed_picture_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.nef', '.cr2', '.dng', '.bmp')
+pictures_with_exif = ('.jpg', '.jpeg')
+allowed_video_extensions = ('.mp4', '.mov', '.avi')
+
+FINGERPRINT_WINDOW = 64 * 1024
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+TIMESTAMP_CACHE_BATCH = 512
+PROGRESS_BATCH = 256
+IN_FLIGHT_PER_WORKER = 4
+COPY_BUFFER_SIZE = 1024 * 1024
+
+MONTH_NAMES = ('', 'January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December')
+
+def _copy_file(infile: os.PathLike, outfile: os.PathLike) -> None:
+    with open(infile, 'rb') as src, open(outfile, 'xb') as dst:
+        size = os.fstat(src.fileno()).st_size
+
+        # Let the kernel copy the data (copy_file_range can even reflink), plain buffered copy as last resort
+        kernel_copies = []
+        if hasattr(os, 'copy_file_range'):
+            kernel_copies.append(lambda remaining: os.copy_file_range(src.fileno(), dst.fileno(), remaining))
+        if hasattr(os, 'sendfile'):
+            kernel_copies.append(lambda remaining: os.sendfile(dst.fileno(), src.fileno(), None, remaining))
+
+        for kernel_copy in kernel_copies:
+            copied = 0
+            try:
+                while copied < size:
+                    n = kernel_copy(size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+
+            if copied == size:
+                break
+
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        else:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+    shutil.copystat(infile, outfile)
 
-def sort_file_in(outfile: os.PathLike, infile: os.PathLike) -> None:
+def sort_file_in(outfile: os.PathLike, infile: os.PathLike, link=False) -> None:
     dirname = os.path.dirname(outfile)
 
     if not os.path.exists(dirname):
@@ -22,66 +72,137 @@ def sort_file_in(outfile: os.PathLike, infile: os.PathLike) -> None:
 
     if os.path.exists(outfile):
         raise ValueError(f'Won\'t copy {infile} to {outfile}. File already exists!')
-    
-    shutil.move(infile, outfile)
 
-def create_moves(pictures:list, out:os.PathLike) -> dir:
-    mapping = {}
+    if link:
+        os.link(infile, outfile)
+        return
+
+    # A rename only touches metadata, across devices the data has to be copied
+    try:
+        os.rename(infile, outfile)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        _copy_file(infile, outfile)
+        os.unlink(infile)
+
+def format_filename(t: datetime.datetime) -> str:
+    # Same as strftime('%m_%d_%H_%M_%S__%-dth_of_%B_at_%Hh_%Mm'), without the glibc only %-d and the locale lookup
+    return f'{t.month:02}_{t.day:02}_{t.hour:02}_{t.minute:02}_{t.second:02}__{t.day}th_of_{MONTH_NAMES[t.month]}_at_{t.hour:02}h_{t.minute:02}m'
+
+def iter_moves(pictures: list, out: os.PathLike):
+    named = []
+    year_dirs = {}
     for timestamp, path in track(pictures, "[green]Sorting files by date...", total=len(pictures)):
-        directory = os.path.join(out, str(timestamp.year))
-        file_ext = os.path.basename(path).split('.')[-1]
-        filename = timestamp.strftime('%m_%d_%H_%M_%S__%-dth_of_%B_at_%Hh_%Mm') + '.' + file_ext
-        new_name = os.path.join(directory, filename)
-
-        if new_name in mapping:
-            mapping[new_name].append(path)
-        else:
-            mapping[new_name] = [path]
-
-    moves = {}
-    for new_name, files in track(mapping.items(), "[green]Finishing up sorting...", total=len(mapping)):
+        # The cached year directory ends with a separator, so the filename can just be appended
+        directory = year_dirs.get(timestamp.year)
+        if directory is None:
+            directory = year_dirs[timestamp.year] = os.path.join(out, str(timestamp.year), '')
+        _, file_ext = os.path.splitext(path)
+        named.append((directory + format_filename(timestamp) + file_ext, path))
+
+    # Sorted, files that end up with the same name are next to each other and can be numbered right away
+    named.sort()
+    for new_name, group in itertools.groupby(named, key=lambda item: item[0]):
+        files = [path for _, path in group]
         if len(files) == 1:
-            moves[new_name] = files[0]
+            yield new_name, files[0]
         else:
+            dir_and_filename, file_ext = os.path.splitext(new_name)
             for i, file in enumerate(files):
-                dir_and_filename, file_ext = new_name.split('.')
-                name = f'{dir_and_filename}_{i+1}.{file_ext}'
-                moves[name] = file
-
-    return moves
-
-def check_update_old_info(moves:dict, json_file: os.PathLike, dry_run=True) -> (dict, int):
-    deleted_duplicates = 0
-    old_info = {}
-    if os.path.exists(json_file):
-        with open(json_file, 'r') as f:
-            old_info = json.load(f)
+                yield f'{dir_and_filename}_{i+1}{file_ext}', file
+
+def create_moves(pictures:list, out:os.PathLike) -> dict:
+    return dict(iter_moves(pictures, out))
+
+def sampled_fingerprint(path: os.PathLike, size: int) -> str:
+    with open(path, 'rb') as f:
+        if size < 3 * FINGERPRINT_WINDOW:
+            return hashlib.md5(f.read()).hexdigest()
+
+        digests = b''
+        for offset in (0, size // 2 - FINGERPRINT_WINDOW // 2, size - FINGERPRINT_WINDOW):
+            f.seek(offset)
+            digests += hashlib.md5(f.read(FINGERPRINT_WINDOW)).digest()
+        return hashlib.md5(digests).hexdigest()
+
+def full_sha256(path: os.PathLike) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            sha.update(block)
+    return sha.hexdigest()
+
+def files_equal(existing_file: os.PathLike, incoming_file: os.PathLike, hashes: dict) -> bool:
+    # Cheapest checks first: size, then a fingerprint of three small windows, then the full hash.
+    # Everything computed for the already sorted file is kept in hashes so later runs can reuse it.
+    existing_st = os.stat(existing_file)
+    existing_size = existing_st.st_size
+    incoming_size = os.path.getsize(incoming_file)
+    if existing_size != incoming_size:
+        return False
+
+    # An in place edit (e.g. fixing EXIF dates) keeps the size, so the mtime has to match as well
+    cached = hashes.get(existing_file)
+    if cached is None or cached['size'] != existing_size or cached.get('mtime') != existing_st.st_mtime_ns:
+        cached = {'size': existing_size, 'mtime': existing_st.st_mtime_ns}
+        hashes[existing_file] = cached
+
+    if 'fingerprint' not in cached:
+        cached['fingerprint'] = sampled_fingerprint(existing_file, existing_size)
+    if cached['fingerprint'] != sampled_fingerprint(incoming_file, incoming_size):
+        return False
+
+    if 'sha256' not in cached:
+        cached['sha256'] = full_sha256(existing_file)
+    return cached['sha256'] == full_sha256(incoming_file)
+
+def _load_json(json_file: os.PathLike) -> dict:
+    if not os.path.exists(json_file):
+        return {}
+    with open(json_file, 'rb') as f:
+        return orjson.loads(f.read())
+
+def _dump_json(obj: dict, json_file: os.PathLike) -> None:
+    with open(json_file, 'wb') as f:
+        f.write(orjson.dumps(obj))
+
+def check_update_old_info(moves:dict, old_info: dict, json_file: os.PathLike, dry_run=True, link=False) -> (dict, list):
+    deleted_duplicates = []
+
+    hash_file = os.path.join(os.path.dirname(json_file), 'hashes.json')
+    hashes = _load_json(hash_file)
+
+    by_basename = {}
+    for new_file in moves:
+        by_basename.setdefault(os.path.basename(new_file), []).append(new_file)
 
     for k, v in track(old_info.items(), description="[green]Checking for duplicates in old info.json ...", total=len(old_info)):
         old_filename = os.path.basename(k)
-        if old_filename in [os.path.basename(new_file) for new_file in moves.keys()]:
+        # Pop, so an incoming file is only matched against one old entry
+        incoming_files = by_basename.pop(old_filename, None)
+        if incoming_files:
             existing_file = k
-            incoming_files = [new_file for new_file in moves.keys() if old_filename in new_file]
             if len(incoming_files) != 1:
                 raise ValueError(f'Found more than one file with the same name like old ({k}) in the new files')
             incoming_file = moves[incoming_files[0]]
             del moves[incoming_files[0]]
 
             # TODO: hack the correct location if I rename the folder
-            if not filecmp.cmp(existing_file.replace('/pictures_sorted/', '/pictures/'), incoming_file, shallow=False):
+            existing_file_resolved = existing_file.replace('/pictures_sorted/', '/pictures/')
+            if not files_equal(existing_file_resolved, incoming_file, hashes):
                 print(f'Files {existing_file} and {incoming_file} are different. Please compare manually!')
-            else:
-                if not dry_run:
-                    deleted_duplicates += 1
-                    os.remove(incoming_file)
-    return moves, deleted_duplicates
+            # With --link the originals stay, and a hardlink of the sorted file is the sorted file itself
+            elif not dry_run and not link and not os.path.samefile(existing_file_resolved, incoming_file):
+                deleted_duplicates.append(incoming_file)
+                os.remove(incoming_file)
+
+    if not dry_run and hashes:
+        _dump_json(hashes, hash_file)
 
-def append_moves_to_json(moves: dict, json_file: os.PathLike, dry_run=True) -> dict:
-    old_info = {}
-    if os.path.exists(json_file):
-        with open(json_file, 'r') as f:
-            old_info = json.load(f)
+    return moves, deleted_duplicates
 
+def append_moves_to_json(moves: dict, old_info: dict, json_file: os.PathLike, dry_run=True) -> dict:
     for k, v in track(old_info.items(), description="[green]Updating info.json ...", total=len(old_info)):
         if k in moves:
             raise print(f'ERROR: {k} still exists in the new info.json, this shouldn\'t have happened')
@@ -92,124 +213,343 @@ def append_moves_to_json(moves: dict, json_file: os.PathLike, dry_run=True) -> d
         if not os.path.exists(json_file):
             os.makedirs(os.path.split(json_file)[0], exist_ok=True)
 
-        with open(json_file, 'w') as f:
-            json.dump(old_info, f)
+        _dump_json(old_info, json_file)
     
     return old_info
 
-def do_move_files(pictures: list, out: os.PathLike) -> None:
+def do_move_files(pictures: list, out: os.PathLike, link=False) -> list:
     print('Moving files...')
 
     moves = create_moves(pictures, out)
 
-    moves, deleted_duplicates = check_update_old_info(moves, os.path.join(out, 'info.json'), dry_run=False)
+    json_file = os.path.join(out, 'info.json')
+    old_info = _load_json(json_file)
+    moves, deleted_duplicates = check_update_old_info(moves, old_info, json_file, dry_run=False, link=link)
 
     for new_file, old_file in track(moves.items(), description="[red]Moving files...", total=len(moves)):
-        sort_file_in(new_file, old_file)
+        sort_file_in(new_file, old_file, link)
     
-    append_moves_to_json(moves, os.path.join(out, 'info.json'), dry_run=False)
-    if deleted_duplicates > 0:
-        print(f"Deleted {deleted_duplicates} duplicates")
+    append_moves_to_json(moves, old_info, json_file, dry_run=False)
+    if len(deleted_duplicates) > 0:
+        print(f"Deleted {len(deleted_duplicates)} duplicates")
+
+    # Everything that is gone from the source tree now
+    if link:
+        return deleted_duplicates
+    return deleted_duplicates + list(moves.values())
 
 def dryrun_move_files(pictures: list, out: os.PathLike) -> None:
     moves = create_moves(pictures, out)
 
-    moves, deleted_duplicates = check_update_old_info(moves, os.path.join(out, 'info.json'))
+    json_file = os.path.join(out, 'info.json')
+    old_info = _load_json(json_file)
+    moves, deleted_duplicates = check_update_old_info(moves, old_info, json_file)
 
     for new_name, file in moves.items():
         print(f"{file} --> \t\t{new_name}")
 
-    append_moves_to_json(moves, os.path.join(out, 'info.json'))
-    if deleted_duplicates > 0:
-        print(f"Would have deleted {deleted_duplicates} duplicates")
+    append_moves_to_json(moves, old_info, json_file)
+    if len(deleted_duplicates) > 0:
+        print(f"Would have deleted {len(deleted_duplicates)} duplicates")
 
-def extract_timestamp_from_filemeta(path: os.PathLike) -> datetime.datetime:
-    ctime = os.path.getctime(path)
-    mtime = os.path.getmtime(path)
+def extract_timestamp_from_filemeta(path: os.PathLike, entry: os.DirEntry = None, today: datetime.date = None) -> datetime.datetime:
+    # DirEntry caches its stat result, so reuse it when the walker handed one down
+    st = entry.stat() if entry is not None else os.stat(path)
+    ctime = st.st_ctime
+    mtime = st.st_mtime
     min_time = datetime.datetime.fromtimestamp(min(ctime, mtime))
-    if min_time.year == datetime.datetime.now().year and min_time.month == datetime.datetime.now().month == min_time.day == datetime.datetime.now().day:
+    if today is None:
+        today = datetime.date.today()
+    # A file created today most likely got its timestamp from being copied, not from being taken
+    if min_time.date() == today:
         raise ValueError(f'Suspicious timestamp {min_time}')
     return min_time
     
-def extract_picture_timestamp(path: os.PathLike) -> datetime.datetime:
-    if any(path.endswith(ext) for ext in pictures_with_exif):
-        img = Image.open(path)
+def _find_exif_segment(f) -> bool:
+    if f.read(2) != b'\xff\xd8':
+        return False
+
+    # Walk the segment headers up to the image data (SOS), only APP1 payloads are looked at
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return False
+        kind = marker[1]
+        while kind == 0xFF:
+            fill = f.read(1)
+            if not fill:
+                return False
+            kind = fill[0]
+
+        if kind in (0xDA, 0xD9):
+            return False
+        if 0xD0 <= kind <= 0xD7 or kind == 0x01:
+            continue
+
+        length = int.from_bytes(f.read(2), 'big')
+        if length < 2:
+            return False
+        if kind == 0xE1:
+            if f.read(6) == b'Exif\x00\x00':
+                return True
+            f.seek(length - 2 - 6, os.SEEK_CUR)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+def has_exif(f) -> bool:
+    found = _find_exif_segment(f)
+    f.seek(0)
+    return found
+
+def read_exif_dates(path: os.PathLike) -> list:
+    # Returns None if the file has no EXIF at all, then there is no point in asking PIL either
+    with open(path, 'rb') as f:
+        if not has_exif(f):
+            return None
+        # exifread stops after the date tags and skips thumbnails and maker notes
+        tags = exifread.process_file(f, details=False, stop_tag='DateTimeDigitized', extract_thumbnail=False)
+    date_tags = ['Image DateTime', 'EXIF DateTimeOriginal', 'EXIF DateTimeDigitized']
+    return [date for date in (str(tags[tag]) for tag in date_tags if tag in tags) if date]
+
+def read_exif_dates_pil(path: os.PathLike) -> list:
+    with Image.open(path) as img:
         exif_data = img._getexif()
-        
-        if exif_data:
-            tags = {ExifTags.TAGS[k]: v for k, v in Image.open(path)._getexif().items() if k in ExifTags.TAGS}
-            date_tags = ['DateTime', 'DateTimeOriginal', 'DateTimeDigitized']
-            dates = [tags.get(tag) for tag in date_tags if tag in tags]
 
-            if len(dates) > 0:
-                return datetime.datetime.strptime(min(dates), '%Y:%m:%d %H:%M:%S')
-    
-    # If exif data is not available, use the file's first modified time
-    return extract_timestamp_from_filemeta(path)
+    if not exif_data:
+        return []
+
+    tags = {ExifTags.TAGS[k]: v for k, v in exif_data.items() if k in ExifTags.TAGS}
+    date_tags = ['DateTime', 'DateTimeOriginal', 'DateTimeDigitized']
+    return [date for date in (tags.get(tag) for tag in date_tags) if date]
+
+def parse_exif_date(s: str) -> datetime.datetime:
+    # EXIF dates are fixed width '%Y:%m:%d %H:%M:%S', slicing is a lot cheaper than strptime
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
 
-def find_pictures(source: str) -> list:
+def extract_picture_timestamp(path: os.PathLike, entry: os.DirEntry = None, today: datetime.date = None) -> datetime.datetime:
+    if path.lower().endswith(pictures_with_exif):
+        dates = read_exif_dates(path)
+        if dates is not None and len(dates) == 0:
+            dates = read_exif_dates_pil(path)
+
+        if dates:
+            # The format sorts lexicographically, so the minimum string is the earliest date
+            return parse_exif_date(min(dates))
+
+    # If exif data is not available, use the file's first modified time
+    return extract_timestamp_from_filemeta(path, entry, today)
+
+def _iter_entries(source: os.PathLike, tree: dict = None, errors: list = None):
+    # If tree is given, it gets {dir: (number of files, subdirs)} for every visited directory
+    stack = [source]
+    while stack:
+        directory = stack.pop()
+        files = 0
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        subdirs.append(entry.path)
+                    else:
+                        files += 1
+                        yield entry
+        except OSError as e:
+            # Skip unreadable directories (lost+found, System Volume Information, ...) like os.walk did.
+            # They aren't recorded in tree, so cleanup never removes them or their parents.
+            if errors is not None:
+                errors.append((e, directory))
+            continue
+
+        if tree is not None:
+            tree[directory] = (files, subdirs)
+
+def _classify(entry: os.DirEntry) -> (str, os.DirEntry):
+    name = entry.name.lower()
+    if name.endswith(allowed_picture_extensions):
+        return 'pic', entry
+    elif name.endswith(allowed_video_extensions):
+        return 'vid', entry
+    return 'skip', entry
+
+def extract_video_timestamp(path: os.PathLike, entry: os.DirEntry = None, today: datetime.date = None) -> datetime.datetime:
+    # Only container tags are needed, so keep ffprobe from analyzing stream data
+    probe = ffmpeg.probe(path, threads=0, fflags='+fastseek', probesize='32k', analyzeduration=0)
+    if 'streams' in probe and len(probe['streams']) > 0 and 'tags' in probe['streams'][0] and 'creation_time' in probe['streams'][0]['tags']:
+        return datetime.datetime.fromisoformat(probe['streams'][0]['tags']['creation_time'])
+    elif 'format' in probe and 'tags' in probe['format'] and 'creation_time' in probe['format']['tags']:
+        return datetime.datetime.fromisoformat(probe['format']['tags']['creation_time'])
+    return extract_timestamp_from_filemeta(path, entry, today)
+
+def _extract(entry: os.DirEntry, kind: str, today: datetime.date) -> (datetime.datetime, os.PathLike):
+    # The entry is passed on so it is only stat'ed if the filemeta fallback is actually needed
+    if kind == 'pic':
+        return extract_picture_timestamp(entry.path, entry, today), entry.path
+    return extract_video_timestamp(entry.path, entry, today), entry.path
+
+def open_timestamp_cache(cache_file: os.PathLike, read_only=False) -> sqlite3.Connection:
+    if read_only:
+        return sqlite3.connect(f'file:{pathname2url(os.path.abspath(cache_file))}?mode=ro', uri=True)
+
+    conn = sqlite3.connect(cache_file)
+    conn.execute('CREATE TABLE IF NOT EXISTS ts(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, ts TEXT)')
+    return conn
+
+def lookup_timestamp(conn: sqlite3.Connection, path: os.PathLike, st: os.stat_result) -> datetime.datetime:
+    row = conn.execute('SELECT ts FROM ts WHERE path=? AND size=? AND mtime=?', (path, st.st_size, st.st_mtime_ns)).fetchone()
+    if row is None:
+        return None
+    return datetime.datetime.fromisoformat(row[0])
+
+def store_timestamps(conn: sqlite3.Connection, rows: list) -> None:
+    conn.executemany('INSERT OR REPLACE INTO ts(path, size, mtime, ts) VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+
+def _drop_timestamp_cache(cache: sqlite3.Connection, cache_file: os.PathLike, e: Exception) -> None:
+    print(f'WARNING: Can\'t use timestamp cache {cache_file}: {e}')
+    if cache is not None:
+        cache.close()
+    return None
+
+def find_pictures(source: str, cache_file: os.PathLike = None, tree: dict = None, dry_run=True) -> list:
     if not os.path.isdir(source):
         raise ValueError('Source is not a directory')
 
     pictures = []
     unmatched = []
     errors = []
-
-    total_files = len([f for _, _, files in os.walk(source) for f in files])
+    today = datetime.date.today()
+
+    # Timestamps of unchanged files (same path, size and mtime) are reused from earlier runs.
+    # The cache is only touched from this thread, the workers just extract. A dryrun only reads it.
+    # It's just an optimization, so if it can't be used the files are extracted as usual.
+    cache = None
+    if cache_file is not None:
+        try:
+            cache = open_timestamp_cache(cache_file, read_only=dry_run)
+        except sqlite3.Error as e:
+            _drop_timestamp_cache(None, cache_file, e)
+    pending = []
 
     with Progress() as progress:
-        task = progress.add_task("[green]Processing files...", total=total_files)
-
-        for root, dirs, files in os.walk(source):
-            for file in files:
-                path = os.path.join(root, file)
-                if any(file.endswith(ext) for ext in allowed_picture_extensions):
-
-
-                    try:
-                        timestamp = extract_picture_timestamp(path)
-                        pictures.append((timestamp, path))
-                    except Exception as e:
-                        errors.append((e, path))
-
-                elif file.endswith('.mp4') or file.endswith('.MP4') or file.endswith('.mov') or file.endswith('.MOV') or file.endswith('.avi') or file.endswith('.AVI'):
-                    try:
-                        probe = ffmpeg.probe(path)
-                        if 'streams' in probe and len(probe['streams']) > 0 and 'tags' in probe['streams'][0] and 'creation_time' in probe['streams'][0]['tags']:
-                            timestamp = datetime.datetime.fromisoformat(probe['streams'][0]['tags']['creation_time'])
-                        elif 'format' in probe and 'tags' in probe['format'] and 'creation_time' in probe['format']['tags']:
-                            timestamp = datetime.datetime.fromisoformat(probe['format']['tags']['creation_time'])
-                        else:
-                            timestamp = extract_timestamp_from_filemeta(path)
-                        pictures.append((timestamp, path))
-                    except Exception as e:
-                        errors.append((e, path))
+        # The total isn't known up front, it grows while walking instead of doing a separate counting pass
+        task = progress.add_task("[green]Processing files...", total=None)
+        total_files = 0
+        # Rendering per file is noticeable on large trees, so the bar is only updated every PROGRESS_BATCH files
+        done = 0
+
+        # PIL and ffprobe spend most of their time in I/O and subprocesses, so threads are enough
+        max_workers = (os.cpu_count() or 1) * 2
+        # Results are collected while walking, so only a few files per worker are ever waiting
+        max_in_flight = max_workers * IN_FLIGHT_PER_WORKER
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            # The trailing None marks the end of the walk, after it everything still running is collected
+            for entry in itertools.chain(_iter_entries(source, tree, errors), [None]):
+                if entry is not None:
+                    total_files += 1
+                    if total_files % PROGRESS_BATCH == 0:
+                        progress.update(task, total=total_files, completed=done)
+
+                    kind, entry = _classify(entry)
+                    if kind == 'skip':
+                        unmatched.append(({}, entry.path))
+                        done += 1
+                        continue
+
+                    timestamp = None
+                    if cache is not None:
+                        try:
+                            timestamp = lookup_timestamp(cache, entry.path, entry.stat())
+                        except sqlite3.Error as e:
+                            cache = _drop_timestamp_cache(cache, cache_file, e)
+                        except Exception as e:
+                            errors.append((e, entry.path))
+                            done += 1
+                            continue
+
+                    if timestamp is not None:
+                        pictures.append((timestamp, entry.path))
+                        done += 1
+                        continue
+
+                    futures[executor.submit(_extract, entry, kind, today)] = entry
                 else:
-                    unmatched.append(({}, path))
-
-                progress.update(task, advance=1)
+                    progress.update(task, total=total_files, completed=done)
+
+                while futures and (entry is None or len(futures) >= max_in_flight):
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        finished_entry = futures.pop(future)
+                        try:
+                            timestamp, path = future.result()
+                            pictures.append((timestamp, path))
+                        except Exception as e:
+                            errors.append((e, finished_entry.path))
+                        else:
+                            if cache is not None and not dry_run:
+                                try:
+                                    st = finished_entry.stat()
+                                except OSError:
+                                    st = None
+                                if st is not None:
+                                    pending.append((path, st.st_size, st.st_mtime_ns, timestamp.isoformat()))
+                                if len(pending) >= TIMESTAMP_CACHE_BATCH:
+                                    try:
+                                        store_timestamps(cache, pending)
+                                    except sqlite3.Error as e:
+                                        cache = _drop_timestamp_cache(cache, cache_file, e)
+                                    pending = []
+
+                        done += 1
+                        if done % PROGRESS_BATCH == 0:
+                            progress.update(task, completed=done)
+
+            progress.update(task, total=total_files, completed=done)
+
+    if cache is not None:
+        try:
+            if pending:
+                store_timestamps(cache, pending)
+            cache.close()
+        except sqlite3.Error as e:
+            _drop_timestamp_cache(cache, cache_file, e)
 
     print(f'Found {len(pictures)} valid files and {len(unmatched) + len(errors)} invalid files...')
     return pictures, unmatched, errors
 
-def cleanup(root: os.PathLike) -> int:
+def cleanup(tree: dict, removed: list) -> int:
+    # Reuses the directory tree recorded by find_pictures instead of walking the source again
+    removed_per_dir = {}
+    for path in removed:
+        directory = os.path.dirname(path)
+        removed_per_dir[directory] = removed_per_dir.get(directory, 0) + 1
 
     deleted = set()
-    
-    for current_dir, subdirs, files in os.walk(root, topdown=False):
 
-        still_has_subdirs = False
-        for subdir in subdirs:
-            if os.path.join(current_dir, subdir) not in deleted:
-                still_has_subdirs = True
-                break
-    
-        if not any(files) and not still_has_subdirs:
-            os.rmdir(current_dir)
+    # Subdirs are always recorded after their parent, so in reverse they are visited (and maybe deleted) first
+    for current_dir in reversed(list(tree)):
+        files, subdirs = tree[current_dir]
+        if files > removed_per_dir.get(current_dir, 0):
+            continue
+
+        if all(subdir in deleted for subdir in subdirs):
+            try:
+                os.rmdir(current_dir)
+            except OSError:
+                # Something was added since the walk, e.g. the output dir lives inside the source
+                continue
             deleted.add(current_dir)
 
     return len(deleted)
 
+def _device_of(path: os.PathLike) -> int:
+    # The output dir may not exist yet, its first existing parent decides where it will be created
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
 def main(argv: list) -> int:
     parser = argparse.ArgumentParser(description='Sort pictures by date')
     parser.add_argument('source', help='Source directory')
@@ -217,6 +557,7 @@ def main(argv: list) -> int:
     parser.add_argument('--apply', help='Move and delete files (dryrun without)', action='store_true')
     parser.add_argument('--verbose', help='Print more information', action='store_true')
     parser.add_argument('--cleanup', help='Remove empty directories', action='store_true')
+    parser.add_argument('--link', help='Hardlink files into the output instead of moving them', action='store_true')
 
     args = parser.parse_args(argv[1:])
 
@@ -229,10 +570,21 @@ def main(argv: list) -> int:
         args.out = os.path.join(base, 'pictures')
         print(f"Output dir wasn't specified, so {args.out} will be used")
 
-    pictures, unmatched, errors = find_pictures(args.source)
+    # Hardlinks can't cross filesystems, fail before anything gets deleted
+    if args.link and _device_of(args.source) != _device_of(os.path.abspath(args.out)):
+        print(f"--link needs {args.source} and {args.out} on the same filesystem")
+        return 1
+
+    # Only --apply creates or writes the timestamp cache, a dryrun just reads it if it's already there
+    cache_file = os.path.join(args.out, '.ts_cache.sqlite')
+    if not (os.path.exists(cache_file) or (args.apply and os.path.isdir(args.out))):
+        cache_file = None
+    tree = {}
+    pictures, unmatched, errors = find_pictures(args.source, cache_file, tree, dry_run=not args.apply)
 
+    removed = []
     if args.apply:
-        do_move_files(pictures, args.out)
+        removed = do_move_files(pictures, args.out, args.link)
     else:
         dryrun_move_files(pictures, args.out)
 
@@ -247,7 +599,7 @@ def main(argv: list) -> int:
             print(f'{path}: {e}')
 
     if args.cleanup:
-        print(f"Deleted {cleanup(args.source)} empty directories")
+        print(f"Deleted {cleanup(tree, removed)} empty directories")
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))